@@ -1,9 +1,10 @@
 import ldap
+import ldap.dn
+import ldap.filter
 import sys
 import math
 import xml.etree.ElementTree as ET
 import requests
-import re
 import dateutil.parser
 from dateutil.tz import tzlocal
 import datetime
@@ -11,6 +12,17 @@ import traceback
 import yaml
 import getopt
 import os
+import json
+import hashlib
+import logging
+import threading
+import time
+import random
+import collections
+import Queue
+import email.utils
+import urllib
+from multiprocessing.pool import ThreadPool
  
 
 from requests.packages.urllib3.fields import RequestField
@@ -20,6 +32,46 @@ ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
 
 xmlns = {'t': 'http://tableau.com/api'}
 
+RESUME = False
+JOURNAL_PATH = "tabsync.journal"
+JOURNAL_FSYNC_BATCH = 50
+FINGERPRINT_PATH = "tabsync.fingerprints"
+FINGERPRINT_VERIFY_HOURS = 24
+FULL_VERIFY = False
+TARGET_USERS = []
+TARGET_GROUPS = []
+# REST API version for the filtered lookups of targeted syncs (Get Groups for User needs 3.7)
+FILTER_API_VERSION = "3.7"
+LOG_LEVEL = "info"
+LOG_LEVELS = ("debug", "info", "warning", "error")
+LOG_JSON = False
+MEMBERSHIP_RESOLVER = "walk"
+
+# Tableau REST request controller defaults (see RequestController)
+REST_MAX_CONCURRENCY = 8
+REST_TIMEOUT = 60
+REST_MAX_RETRIES = 5
+
+# LDAP replica pool defaults (see LDAPReplicaPool)
+LDAP_TIMEOUT = 10
+LDAP_HEDGE_PERCENTILE = 95
+LDAP_HEDGE_DELAY = 1.0
+LDAP_REPLICA_COOLDOWN = 60
+LDAP_WORKERS = 8
+
+# Matching rule that makes AD evaluate memberOf through nested groups
+LDAP_MATCHING_RULE_IN_CHAIN = "1.2.840.113556.1.4.1941"
+# Root DSE supportedCapabilities value advertised by Active Directory
+LDAP_CAP_ACTIVE_DIRECTORY = "1.2.840.113556.1.4.800"
+# Server-side filters for the transitive members of a group, by resolver
+TRANSITIVE_MEMBER_FILTERS = {
+    'inchain': "(&(objectClass={0})(memberOf:" + LDAP_MATCHING_RULE_IN_CHAIN + ":={1}))",
+    'memberof': "(&(objectClass={0})(memberOf={1}))",
+    'ismemberof': "(&(objectClass={0})(isMemberOf={1}))",
+}
+
+LOG = logging.getLogger('tabsync')
+
 ###user and group class
 
 class User:
@@ -42,6 +94,137 @@ class Group:
         else:
             self.members = members
 
+class LDAPUserList(list):
+    """
+    List of the LDAP users found while expanding groups.
+
+    Users are also indexed by username, and merging is locked so several
+    groups can be expanded concurrently.
+    """
+    def __init__(self):
+        list.__init__(self)
+        self.by_name = {}
+        self.lock = threading.Lock()
+
+    def add_to_group(self, username, group):
+        """
+        Adds the user 'username' to 'group', creating the User the first time
+        the username is seen.
+        """
+        with self.lock:
+            user = self.by_name.get(username)
+            if user is None:
+                user = User(username)
+                self.by_name[username] = user
+                self.append(user)
+            user.memberOf.append(group)
+            group.members.append(user)
+
+class EntityIndex:
+    """
+    In-run index of the Tableau Server entities seen so far.
+
+    Holds name->ID maps for users and groups and the set of member user IDs
+    of every group. It is filled from the initial snapshot of the site and
+    kept up to date by the REST helpers on every create and delete, so
+    conflicts can be resolved without listing the site again. Updates are
+    locked because operations are executed concurrently.
+    """
+    def __init__(self):
+        self.user_ids = {}
+        self.user_names = {}
+        self.group_ids = {}
+        self.members = {}
+        self.users_loaded = False
+        self.groups_loaded = False
+        self.lock = threading.RLock()
+
+    def load_users(self, user_elements):
+        with self.lock:
+            for user in user_elements:
+                self.add_user(user.get('name'), user.get('id'))
+            self.users_loaded = True
+
+    def load_groups(self, group_elements):
+        with self.lock:
+            for group in group_elements:
+                self.add_group(group.get('name'), group.get('id'))
+            self.groups_loaded = True
+
+    def add_user(self, username, user_id):
+        with self.lock:
+            self.user_ids[username] = user_id
+            self.user_names[user_id] = username
+
+    def remove_user(self, user_id):
+        with self.lock:
+            username = self.user_names.pop(user_id, None)
+            if username is not None:
+                self.user_ids.pop(username, None)
+            for member_ids in self.members.values():
+                member_ids.discard(user_id)
+
+    def add_group(self, groupname, group_id):
+        with self.lock:
+            self.group_ids[groupname] = group_id
+            self.members.setdefault(group_id, set())
+
+    def remove_group(self, group_id):
+        with self.lock:
+            for groupname, indexed_id in list(self.group_ids.items()):
+                if indexed_id == group_id:
+                    del self.group_ids[groupname]
+            self.members.pop(group_id, None)
+
+    def add_member(self, group_id, user_id):
+        with self.lock:
+            self.members.setdefault(group_id, set()).add(user_id)
+
+    def remove_member(self, group_id, user_id):
+        with self.lock:
+            self.members.get(group_id, set()).discard(user_id)
+
+INDEX = EntityIndex()
+
+####
+# Functions for logging
+####
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats each log record as one JSON object per line.
+
+    Values passed with extra={'fields': {...}} are added to the object as is,
+    so counts and IDs stay machine readable.
+    """
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'message': record.getMessage()}
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(level = "info", json_lines = False):
+    """
+    Sends the tabsync log to stdout at the given level (one of LOG_LEVELS),
+    either as text or as JSON lines.
+
+    Messages are formatted lazily by the logging module, so records below the
+    level cost a single level check.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    if json_lines:
+        handler.setFormatter(JsonLinesFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    LOG.handlers = [handler]
+    LOG.propagate = False
+    LOG.setLevel(getattr(logging, level.upper()))
+
 ####
 # Functions for constructing HTTP multi-part requests and dealing with errors
 ####
@@ -78,12 +261,11 @@ def _handle_error(server_response):
     
     Returns the error code and error message.
     """
-    print("An error occurred")
     xml_response = ET.fromstring(_encode_for_display(server_response.text))
     error_code = xml_response.find('t:error', namespaces=xmlns).attrib.get('code')
     error_detail = xml_response.find('.//t:detail', namespaces=xmlns).text
-    print("\tError code: " + str(error_code))
-    print("\tError detail: " + str(error_detail))
+    LOG.error("An error occurred. Error code: %s Error detail: %s", error_code, error_detail,
+              extra={'fields': {'error_code': error_code, 'status': server_response.status_code}})
     return error_code, error_detail
 
 
@@ -96,6 +278,204 @@ def _encode_for_display(text):
     """
     return text.encode('ascii', errors="backslashreplace").decode('utf-8')
 
+####
+# Request controller shared by all Tableau Server REST calls
+####
+
+
+class RequestController:
+    """
+    Gate for Tableau Server REST calls that adapts the number of requests in
+    flight to what the server sustains.
+
+    The concurrency limit follows AIMD: every normal response raises the
+    limit by 1/limit; a 429, a 5xx or a timeout cuts it by half, and latency
+    growth on an endpoint cuts it by 10%, at most once per observed round
+    trip. Latency counts as grown when the last few responses of an endpoint
+    average more than 'latency_tolerance' times the median of its recent
+    'latency_window' responses, so responses that are slow only because of
+    their size do not count as congestion.
+
+    429 and 503 responses are retried for every method because the server
+    rejected the request without processing it. Other 5xx responses, timeouts
+    and connection errors are retried only for idempotent calls (GET and
+    DELETE, or idempotent=True). Retries wait for Retry-After when the server
+    sends it and for a jittered exponential backoff otherwise.
+    """
+    def __init__(self, max_limit = REST_MAX_CONCURRENCY, timeout = REST_TIMEOUT, max_retries = REST_MAX_RETRIES,
+                 initial_limit = 2, latency_tolerance = 3.0, latency_window = 20, backoff_base = 0.5, backoff_cap = 30.0,
+                 max_retry_after = 300.0):
+        self.max_limit = max(1, max_limit)
+        self.limit = float(min(initial_limit, self.max_limit))
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.latency_tolerance = latency_tolerance
+        self.latency_window = latency_window
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_retry_after = max_retry_after
+        self.in_flight = 0
+        self.latencies = {}
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self.counters = {'requests': 0, 'retries': 0, 'throttled': 0, 'errors': 0}
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, idempotent = None, **kwargs):
+        """
+        Sends a request once a slot is free, retrying transient failures.
+
+        Returns the final response. Connection errors and timeouts are raised
+        once they can no longer be retried.
+        """
+        if idempotent is None:
+            idempotent = method in ('GET', 'DELETE')
+        kwargs.setdefault('verify', CERT_PATH)
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = self._endpoint(method, url)
+        attempt = 0
+        while True:
+            self._acquire()
+            started = time.time()
+            try:
+                server_response = requests.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                self._release(endpoint, overloaded=True)
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                LOG.warning("%s %s failed (%s), retrying in %.1fs", method, url, e, delay)
+            else:
+                status = server_response.status_code
+                throttled = status in (429, 503)
+                self._release(endpoint, overloaded=throttled or status >= 500, latency=time.time() - started)
+                if not (throttled or (status >= 500 and idempotent)) or attempt >= self.max_retries:
+                    return server_response
+                delay = max(self._retry_after(server_response), self._backoff(attempt))
+                LOG.warning("%s %s returned %d, retrying in %.1fs", method, url, status, delay)
+            attempt += 1
+            with self.condition:
+                self.counters['retries'] += 1
+            time.sleep(delay)
+
+    def metrics(self):
+        with self.condition:
+            metrics = dict(self.counters)
+            metrics.update({'limit': round(self.limit, 2), 'max_limit': self.max_limit, 'in_flight': self.in_flight})
+        return metrics
+
+    def _acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.counters['requests'] += 1
+
+    def _endpoint(self, method, url):
+        # Groups requests by method and path, with Tableau IDs and the query string left out
+        path = url.split('?', 1)[0]
+        return method + " " + "/".join("*" if len(segment) == 36 and segment.count('-') == 4 else segment
+                                       for segment in path.split('/'))
+
+    def _latency_grew(self, endpoint, latency):
+        # Compares the recent average of the endpoint with the median of its window
+        samples = self.latencies.get(endpoint)
+        if samples is None:
+            samples = self.latencies[endpoint] = collections.deque(maxlen=self.latency_window)
+        grew = False
+        if len(samples) >= self.latency_window // 2:
+            median = sorted(samples)[len(samples) // 2]
+            recent = list(samples)[-4:] + [latency]
+            grew = sum(recent) / len(recent) > self.latency_tolerance * median
+        samples.append(latency)
+        return grew
+
+    def _release(self, endpoint, overloaded = False, latency = None):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.time()
+            if overloaded:
+                self.counters['throttled' if latency is not None else 'errors'] += 1
+                self._decrease(now, 0.5, latency)
+            elif self._latency_grew(endpoint, latency):
+                self._decrease(now, 0.9, latency)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def _decrease(self, now, factor, latency):
+        # A burst of slow or rejected responses counts as a single congestion signal
+        if now - self.last_decrease < (latency or 0.0):
+            return
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit * factor)
+        LOG.debug("REST concurrency limit lowered to %.2f", self.limit)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _retry_after(self, server_response):
+        retry_after = server_response.headers.get('Retry-After')
+        if retry_after is None:
+            return 0.0
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            retry_date = email.utils.parsedate_tz(retry_after)
+            if retry_date is None:
+                return 0.0
+            delay = email.utils.mktime_tz(retry_date) - time.time()
+        return min(self.max_retry_after, max(0.0, delay))
+
+CONTROLLER = RequestController()
+
+
+def _parallel_map(func, items, workers = None):
+    """
+    Applies 'func' to every item on a thread pool and returns the results in order.
+
+    For REST calls the request controller decides how many actually run at
+    once; the pool only needs enough threads to keep it busy. 'workers'
+    defaults to the controller's maximum. A sys.exit() inside 'func' is
+    re-raised in the calling thread.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+
+    def call(item):
+        try:
+            return True, func(item)
+        except SystemExit, e:
+            return False, e
+
+    pool = ThreadPool(min(len(items), workers or CONTROLLER.max_limit))
+    try:
+        # map_async().get() with a timeout keeps the main thread interruptible
+        results = pool.map_async(call, items).get(sys.maxint)
+    finally:
+        pool.close()
+        pool.join()
+    for completed, value in results:
+        if not completed:
+            raise value
+    return [value for completed, value in results]
+
+
+def log_request_metrics():
+    metrics = CONTROLLER.metrics()
+    LOG.info("REST requests: %d, retries: %d, throttled: %d, errors: %d, concurrency limit: %.2f of %d",
+             metrics['requests'], metrics['retries'], metrics['throttled'], metrics['errors'], metrics['limit'], metrics['max_limit'],
+             extra={'fields': {'rest': metrics}})
+
 ####
 # Functions for authentication (sign in and sign out)
 ####
@@ -124,14 +504,13 @@ def sign_in(name, password, site=""):
 
     # Makes the request to Tableau Server
     try:
-        server_response = requests.post(url, data=xml_payload_for_request, verify=CERT_PATH)
-    except requests.exceptions.ConnectionError:
-        traceback.print_exc(file=sys.stdout)
-        print("Unexpected Error: {0} Check Tableau Server host settings in config.".format(sys.exc_info()[0]))
+        server_response = CONTROLLER.post(url, data=xml_payload_for_request, idempotent=True)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        LOG.error("Unexpected Error: %s Check Tableau Server host settings in config.", sys.exc_info()[0], exc_info=True)
         sys.exit(1)
     if server_response.status_code != 200:
-        print(server_response.text)
-        print("Check Tableau Server login/host settings in config.")
+        LOG.error("%s", server_response.text)
+        LOG.error("Check Tableau Server login/host settings in config.")
         sys.exit(1)
     # Reads and parses the response
     xml_response = ET.fromstring(_encode_for_display(server_response.text))
@@ -148,7 +527,7 @@ def sign_out():
     """
     global TOKEN
     url = SERVER + "/api/2.1/auth/signout"
-    server_response = requests.post(url, headers={'x-tableau-auth': TOKEN}, verify=CERT_PATH)
+    server_response = CONTROLLER.post(url, headers={'x-tableau-auth': TOKEN})
     TOKEN = None
     return
 
@@ -159,8 +538,8 @@ def create_user(name):
     xml_payload_for_request = ET.Element('tsRequest')
     user = ET.SubElement(xml_payload_for_request, 'user', name=name, siteRole="Unlicensed")
     xml_payload_for_request = ET.tostring(xml_payload_for_request)
-    print(xml_payload_for_request)
-    server_response = requests.post(url, data=xml_payload_for_request, headers={'x-tableau-auth': TOKEN}, verify=CERT_PATH)
+    LOG.debug("create_user payload: %s", xml_payload_for_request)
+    server_response = CONTROLLER.post(url, data=xml_payload_for_request, headers={'x-tableau-auth': TOKEN})
 
     # Checks HTTP status code. If the code is anything _except_ success (here, 201),
     # the code reads the <error> block from the response. The error code
@@ -168,12 +547,25 @@ def create_user(name):
     # provides a list of error codes that might be returned for that method.
     if server_response.status_code != 201:
         error, detail = _handle_error(server_response)
+        # 409017 is the error code when the user already exists, for example
+        # when an interrupted run is resumed.
+        if error == "409017":
+            if not INDEX.users_loaded:
+                INDEX.load_users(query_users())
+            user_id = INDEX.user_ids.get(name)
+            if user_id is not None:
+                return ET.Element('user', id=user_id, name=name)
+            else:
+                LOG.error("%s", detail)
+                sys.exit(1) # Exit the program altogether
     xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    return xml_response.find('t:user', namespaces=xmlns)
+    user = xml_response.find('t:user', namespaces=xmlns)
+    INDEX.add_user(user.get('name'), user.get('id'))
+    return user
 
 def remove_user(user_id):
     url = SERVER + "/api/2.1/sites/{0}/users/{1}".format(SITE_ID, user_id)
-    server_response = requests.delete(url, headers={'x-tableau-auth': TOKEN}, verify=CERT_PATH)
+    server_response = CONTROLLER.delete(url, headers={'x-tableau-auth': TOKEN})
 
     # Checks HTTP status code. If the code is anything _except_ success (here, 201),
     # the code reads the <error> block from the response. The error code
@@ -183,11 +575,12 @@ def remove_user(user_id):
         error, detail = _handle_error(server_response)
         return False
         
+    INDEX.remove_user(user_id)
     return True
 
 def remove_group(group_id):
     url = SERVER + "/api/2.1/sites/{0}/groups/{1}".format(SITE_ID, group_id)
-    server_response = requests.delete(url, headers={'x-tableau-auth': TOKEN}, verify=CERT_PATH)
+    server_response = CONTROLLER.delete(url, headers={'x-tableau-auth': TOKEN})
 
     # Checks HTTP status code. If the code is anything _except_ success (here, 201),
     # the code reads the <error> block from the response. The error code
@@ -197,6 +590,7 @@ def remove_group(group_id):
         error, detail = _handle_error(server_response)
         return False
         
+    INDEX.remove_group(group_id)
     return True
 
 def create_group(name):
@@ -217,7 +611,7 @@ def create_group(name):
     xml_payload_for_request = ET.Element('tsRequest')
     group = ET.SubElement(xml_payload_for_request, 'group', name=name)
     xml_payload_for_request = ET.tostring(xml_payload_for_request)
-    server_response = requests.post(url, data=xml_payload_for_request, headers={'x-tableau-auth': TOKEN}, verify=CERT_PATH)
+    server_response = CONTROLLER.post(url, data=xml_payload_for_request, headers={'x-tableau-auth': TOKEN})
 
     # Checks HTTP status code. If the code is anything _except_ success (here, 201),
     # the code reads the <error> block from the response. The error code
@@ -227,17 +621,21 @@ def create_group(name):
         error, detail = _handle_error(server_response)
         # 409009 is the error code when the group already exists.
         if error == "409009":
-            # A group with the specified name already exists. Therefore, gets a list
-            # of existing groups and finds the ID of the group with the specified name.
-            groups = query_groups()
-            for group in groups:
-                if group.get('name') == name:
-                    return group
+            # A group with the specified name already exists. Therefore, looks up the
+            # ID of the group with the specified name in the entity index. The group
+            # list is only fetched if the index was not filled by this run.
+            if not INDEX.groups_loaded:
+                INDEX.load_groups(query_groups())
+            group_id = INDEX.group_ids.get(name)
+            if group_id is not None:
+                return ET.Element('group', id=group_id, name=name)
             else:
-                print(detail)
+                LOG.error("%s", detail)
                 sys.exit(1) # Exit the program altogether
     xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    return xml_response.find('t:group', namespaces=xmlns)
+    group = xml_response.find('t:group', namespaces=xmlns)
+    INDEX.add_group(group.get('name'), group.get('id'))
+    return group
 
 
 def add_user_to_group(user_id, group_id):
@@ -245,7 +643,7 @@ def add_user_to_group(user_id, group_id):
     xml_payload_for_request = ET.Element('tsRequest')
     user = ET.SubElement(xml_payload_for_request, 'user', id=user_id)
     xml_payload_for_request = ET.tostring(xml_payload_for_request)
-    server_response = requests.post(url, data=xml_payload_for_request, headers={'x-tableau-auth': TOKEN}, verify=CERT_PATH)
+    server_response = CONTROLLER.post(url, data=xml_payload_for_request, headers={'x-tableau-auth': TOKEN})
 
     # Checks HTTP status code. If the code is anything _except_ success (here, 201),
     # the code reads the <error> block from the response. The error code
@@ -253,23 +651,18 @@ def add_user_to_group(user_id, group_id):
     # provides a list of error codes that might be returned for that method.
     if server_response.status_code != 200:
         error, detail = _handle_error(server_response)
-        # 409009 is the error code when the group already exists.
+        # 409011 is the error code when the user is already a member of the group.
         if error == "409011":
-            # A group with the specified name already exists. Therefore, gets a list
-            # of existing groups and finds the ID of the group with the specified name.
-            groups = query_groups()
-            for group in groups:
-                if group.get('name') == name:
-                    return group
-            else:
-                print(detail)
-                sys.exit(1) # Exit the program altogether
+            INDEX.add_member(group_id, user_id)
+            return None
+        return False
     xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    INDEX.add_member(group_id, user_id)
     return xml_response.find('t:user', namespaces=xmlns)
 
 def remove_user_from_group(user_id, group_id):
     url = SERVER + "/api/2.1/sites/{0}/groups/{1}/users/{2}".format(SITE_ID, group_id, user_id)
-    server_response = requests.delete(url, headers={'x-tableau-auth': TOKEN}, verify=CERT_PATH)
+    server_response = CONTROLLER.delete(url, headers={'x-tableau-auth': TOKEN})
 
     # Checks HTTP status code. If the code is anything _except_ success (here, 201),
     # the code reads the <error> block from the response. The error code
@@ -279,352 +672,930 @@ def remove_user_from_group(user_id, group_id):
         error, detail = _handle_error(server_response)
         return False
         
+    INDEX.remove_member(group_id, user_id)
     return True
 
 
 ##functions for querying groups and users
 
+def _query_paged(url, element_name):
+    """
+    Returns all <element_name> elements of a paginated listing at 'url'.
+
+    The function paginates over the results (if required) using a page size of 100.
+    The first page gives the total count; the remaining pages are fetched
+    concurrently through the request controller.
+    """
+    pageSize = 100
+
+    def get_page(page):
+        paged_url = url + ("&" if "?" in url else "?") + "pageSize={}&pageNumber={}".format(pageSize, page)
+        server_response = CONTROLLER.get(paged_url, headers={"x-tableau-auth": TOKEN})
+        if server_response.status_code != 200:
+            LOG.error("%s", _encode_for_display(server_response.text))
+            sys.exit(1)
+        return ET.fromstring(_encode_for_display(server_response.text))
+
+    xml_response = get_page(1)
+    total_count = int(xml_response.find('t:pagination', namespaces=xmlns).attrib.get('totalAvailable'))
+    elements = xml_response.findall('.//t:' + element_name, namespaces=xmlns)
+    number_of_pages = int(math.ceil(total_count / float(pageSize)))
+    # Starts from page 2 because page 1 has already been returned
+    for page_response in _parallel_map(get_page, range(2, number_of_pages + 1)):
+        elements.extend(page_response.findall('.//t:' + element_name, namespaces=xmlns))
+    return elements
+
 def query_groups():
     """
     Returns a list of groups on the site (a list of <group> elements).
-    
-    The function paginates over the results (if required) using a page size of 100.
     """
-    pageNum, pageSize = 1, 100
-    url = SERVER + "/api/2.1/sites/{0}/groups".format(SITE_ID)
-    paged_url = url + "?pageSize={}&pageNumber={}".format(pageSize, pageNum)
-    server_response = requests.get(paged_url, headers={"x-tableau-auth": TOKEN}, verify=CERT_PATH)
-    if server_response.status_code != 200:
-        print(_encode_for_display(server_response.text))
-        sys.exit(1)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    total_count_of_groups = int(xml_response.find('t:pagination', namespaces=xmlns).attrib.get('totalAvailable'))
-    if total_count_of_groups > pageSize:
-        groups = []  # A list to hold the groups returned from the server
-        groups.extend(xml_response.findall('.//t:group', namespaces=xmlns))
-        number_of_pages = int(math.ceil(total_count_of_groups / pageSize))
-        # Starts from page 2 because page 1 has already been returned
-        for page in range(2, number_of_pages + 1):
-            paged_url = url + "?pageSize={}&pageNumber={}".format(pageSize, page)
-            server_response = requests.get(paged_url, headers={"x-tableau-auth": TOKEN}, verify=CERT_PATH)
-            if server_response.status_code != 200:
-                print(_encode_for_display(server_response.text))
-                sys.exit(1)
-            groups_from_page = ET.fromstring(_encode_for_display(server_response.text)).findall('.//t:group', namespaces=xmlns)
-            # Adds the new page of groups to the list
-            groups.extend(groups_from_page)
-    else:
-        groups = xml_response.findall('.//t:group', namespaces=xmlns)
-    return groups
+    return _query_paged(SERVER + "/api/2.1/sites/{0}/groups".format(SITE_ID), 'group')
 
 def query_users():
     """
     Returns a list of users on the site (a list of <user> elements).
-
-    The function paginates over the results (if required) using a page size of 100.
     """
-    pageNum, pageSize = 1, 100
-    url = SERVER + "/api/2.1/sites/{0}/users".format(SITE_ID)
-    paged_url = url + "?pageSize={}&pageNumber={}".format(pageSize, pageNum)
-    server_response = requests.get(paged_url, headers={"x-tableau-auth": TOKEN}, verify=CERT_PATH)
-    if server_response.status_code != 200:
-        print(_encode_for_display(server_response.text))
-        sys.exit(1)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    total_count_of_users = int(xml_response.find('t:pagination', namespaces=xmlns).attrib.get('totalAvailable'))
-    if total_count_of_users > pageSize:
-        users = []  # A list to hold the users returned from the server
-        users.extend(xml_response.findall('.//t:user', namespaces=xmlns))
-        number_of_pages = int(math.ceil(total_count_of_users / pageSize))
-        # Starts from page 2 because page 1 has already been returned
-        for page in range(2, number_of_pages + 1):
-            paged_url = url + "?pageSize={}&pageNumber={}".format(pageSize, page)
-            server_response = requests.get(paged_url, headers={"x-tableau-auth": TOKEN}, verify=CERT_PATH)
-            if server_response.status_code != 200:
-                print(_encode_for_display(server_response.text))
-                sys.exit(1)
-            users_from_page = ET.fromstring(_encode_for_display(server_response.text)).findall('.//t:user', namespaces=xmlns)
-            # Adds the new page of users to the list
-            users.extend(users_from_page)
-    else:
-        users = xml_response.findall('.//t:user', namespaces=xmlns)
-    return users
+    return _query_paged(SERVER + "/api/2.1/sites/{0}/users".format(SITE_ID), 'user')
 
 def get_users_in_group(group_id):
     """
-    Returns a list of users on the site (a list of <user> elements).
+    Returns a list of users in the group (a list of <user> elements).
+    """
+    return _query_paged(SERVER + "/api/2.1/sites/{0}/groups/{1}/users".format(SITE_ID, group_id), 'user')
 
-    The function paginates over the results (if required) using a page size of 100.
+def _quote(name):
     """
-    pageNum, pageSize = 1, 100
-    url = SERVER + "/api/2.1/sites/{0}/groups/{1}/users".format(SITE_ID, group_id)
-    paged_url = url + "?pageSize={}&pageNumber={}".format(pageSize, pageNum)
-    server_response = requests.get(paged_url, headers={"x-tableau-auth": TOKEN}, verify=CERT_PATH)
-    if server_response.status_code != 200:
-        print(_encode_for_display(server_response.text))
-        sys.exit(1)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    total_count_of_users = int(xml_response.find('t:pagination', namespaces=xmlns).attrib.get('totalAvailable'))
-    if total_count_of_users > pageSize:
-        users = []  # A list to hold the users returned from the server
-        users.extend(xml_response.findall('.//t:user', namespaces=xmlns))
-        number_of_pages = int(math.ceil(total_count_of_users / pageSize))
-        # Starts from page 2 because page 1 has already been returned
-        for page in range(2, number_of_pages + 1):
-            paged_url = url + "?pageSize={}&pageNumber={}".format(pageSize, page)
-            server_response = requests.get(paged_url, headers={"x-tableau-auth": TOKEN}, verify=CERT_PATH)
-            if server_response.status_code != 200:
-                print(_encode_for_display(server_response.text))
-                sys.exit(1)
-            users_from_page = ET.fromstring(_encode_for_display(server_response.text)).findall('.//t:user', namespaces=xmlns)
-            # Adds the new page of users to the list
-            users.extend(users_from_page)
-    else:
-        users = xml_response.findall('.//t:user', namespaces=xmlns)
-    return users
+    URL-encodes a user or group name for use in a filter expression.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return urllib.quote(name, safe='')
 
-## LDAP routines
-def getLDAPUser(username):
+def query_user_by_name(name):
+    """
+    Returns the <user> element of the user with the given name, or None.
+    """
+    users = _query_paged(SERVER + "/api/{0}/sites/{1}/users?filter=name:eq:{2}".format(FILTER_API_VERSION, SITE_ID, _quote(name)), 'user')
+    return users[0] if users else None
 
-    l = ldap.initialize(LDAP_HOST)
-    l.set_option(ldap.OPT_X_TLS,ldap.OPT_X_TLS_DEMAND)
-    l.set_option( ldap.OPT_X_TLS_DEMAND, True )
-    searchFilter = "(&(uid={0})(objectClass={1}))".format(username, USER_OBJECT_CLASS)
-    #this will scope the entire subtree under UserUnits
-    searchScope = ldap.SCOPE_SUBTREE
-    #Bind to the server
-    try:
+def query_group_by_name(name):
+    """
+    Returns the <group> element of the group with the given name, or None.
+    """
+    groups = _query_paged(SERVER + "/api/{0}/sites/{1}/groups?filter=name:eq:{2}".format(FILTER_API_VERSION, SITE_ID, _quote(name)), 'group')
+    return groups[0] if groups else None
+
+def get_groups_for_user(user_id):
+    """
+    Returns a list of the groups the user is a member of (a list of <group> elements).
+    """
+    return _query_paged(SERVER + "/api/{0}/sites/{1}/users/{2}/groups".format(FILTER_API_VERSION, SITE_ID, user_id), 'group')
+
+## LDAP replica routing
+
+class LDAPReplica:
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.in_flight = 0
+        self.down_until = 0.0
+        self.idle = []
+        self.searches = 0
+        self.failures = 0
+
+
+class LDAPReplicaPool:
+    """
+    Spreads LDAP searches over a list of replicas.
+
+    Each search goes to the better of two randomly picked healthy replicas,
+    scored by their latency (EWMA) and the searches they have in flight. A
+    search still running after the 'hedge_percentile' latency of recent
+    searches is also sent to a second replica, and the first answer wins.
+    A replica that cannot be reached is left out for 'cooldown' seconds and
+    the search is retried on another replica. A search that runs past
+    'timeout' on a reachable replica fails with ldap.TIMEOUT unless a hedged
+    copy answers; the replica is not left out for it. Bound connections are
+    reused between searches.
+    """
+    CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR)
+
+    def __init__(self, urls, timeout = LDAP_TIMEOUT, hedge_percentile = LDAP_HEDGE_PERCENTILE,
+                 cooldown = LDAP_REPLICA_COOLDOWN, hedge_delay = LDAP_HEDGE_DELAY):
+        self.replicas = [LDAPReplica(url) for url in urls]
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.cooldown = cooldown
+        self.hedge_delay = hedge_delay
+        self.latencies = collections.deque(maxlen=200)
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def search(self, base_dn, searchFilter, attrlist = None, searchScope = ldap.SCOPE_SUBTREE):
+        """
+        Returns the (dn, attributes) tuples matching the search.
+
+        LDAP errors returned by a replica that answered are raised as
+        ldap.LDAPError. Wrong bind credentials, or no reachable replica, end
+        the program.
+        """
+        query = (base_dn, searchScope, searchFilter, attrlist)
+        tried = set()
+        while True:
+            primary = self._choose(tried)
+            if primary is None:
+                LOG.error("Unexpected Error: No LDAP replica could be reached (%s). Check LDAP host settings in config.",
+                          ", ".join(replica.url for replica in self.replicas))
+                sys.exit(1)
+            tried.add(primary)
+            outcome = self._hedged_search(primary, tried, query)
+            if outcome is None:
+                continue
+            completed, value = outcome
+            if completed:
+                return value
+            if isinstance(value, ldap.INVALID_CREDENTIALS):
+                LOG.error('Your LDAP username or password is incorrect')
+                sys.exit(1)
+            raise value
+
+    def close(self):
+        for replica in self.replicas:
+            with self.lock:
+                idle, replica.idle = replica.idle, []
+            for l in idle:
+                self._unbind(l)
+
+    def metrics(self):
+        with self.lock:
+            return dict((replica.url, {'searches': replica.searches, 'failures': replica.failures,
+                                       'latency': round(replica.latency or 0.0, 4),
+                                       'healthy': replica.down_until <= time.time()})
+                        for replica in self.replicas)
+
+    def log_metrics(self):
+        for url, replica_metrics in sorted(self.metrics().items()):
+            LOG.info("LDAP replica %s: %d searches, %d failures, %.1f ms latency%s", url, replica_metrics['searches'],
+                     replica_metrics['failures'], replica_metrics['latency'] * 1000, "" if replica_metrics['healthy'] else " (down)",
+                     extra={'fields': {'ldap_replica': url, 'ldap': replica_metrics}})
+        if self.hedges:
+            LOG.info("LDAP searches hedged to a second replica: %d", self.hedges, extra={'fields': {'ldap_hedges': self.hedges}})
+
+    def _hedged_search(self, primary, tried, query):
+        # Returns (True, entries), (False, LDAPError) or None if every replica asked was unreachable
+        results = Queue.Queue()
+        self._start(primary, query, results)
+        launched = 1
+        try:
+            outcome = results.get(timeout=self._hedge_after())
+        except Queue.Empty:
+            secondary = self._choose(tried, healthy_only=True)
+            if secondary is not None:
+                tried.add(secondary)
+                with self.lock:
+                    self.hedges += 1
+                LOG.debug("LDAP search on %s is slow, hedging to %s", primary.url, secondary.url)
+                self._start(secondary, query, results)
+                launched += 1
+            outcome = results.get(timeout=sys.maxint)
+        # An unreachable replica or a failed search waits for the hedged copy
+        while launched > 1 and (outcome is None or not outcome[0]):
+            launched -= 1
+            other = results.get(timeout=sys.maxint)
+            if outcome is None or (other is not None and other[0]):
+                outcome = other
+        return outcome
+
+    def _start(self, replica, query, results):
+        def run():
+            try:
+                outcome = self._search_on(replica, query)
+            except Exception, e:
+                outcome = False, e
+            results.put(outcome)
+        worker = threading.Thread(target=run)
+        worker.daemon = True
+        worker.start()
+
+    def _search_on(self, replica, query):
+        base_dn, searchScope, searchFilter, attrlist = query
+        with self.lock:
+            replica.in_flight += 1
+        started = time.time()
+        try:
+            fresh = False
+            while True:
+                l = None
+                try:
+                    l, reused = self._connection(replica, fresh)
+                    entries = l.search_ext_s(base_dn, searchScope, searchFilter, attrlist, timeout=self.timeout)
+                    break
+                except self.CONNECTION_ERRORS, e:
+                    if l is not None:
+                        self._unbind(l)
+                    if l is not None and isinstance(e, ldap.TIMEOUT):
+                        # the replica is up, the search itself is slow
+                        return False, e
+                    if l is not None and reused and not fresh:
+                        # the server or a load balancer dropped the idle connection, try a new one
+                        LOG.debug("Idle connection to LDAP replica %s was closed (%s), reconnecting", replica.url, e)
+                        fresh = True
+                        continue
+                    self._mark_down(replica, e)
+                    return None
+                except ldap.LDAPError, e:
+                    self._finish(replica, l)
+                    return False, e
+        finally:
+            with self.lock:
+                replica.in_flight -= 1
+        self._observe(replica, time.time() - started)
+        self._finish(replica, l)
+        return True, [entry for entry in entries if entry[0] is not None]
+
+    def _connection(self, replica, fresh = False):
+        # Returns a bound connection and whether it was reused from the idle list
+        if not fresh:
+            with self.lock:
+                if replica.idle:
+                    return replica.idle.pop(), True
+        l = ldap.initialize(replica.url)
+        l.set_option(ldap.OPT_X_TLS,ldap.OPT_X_TLS_DEMAND)
+        l.set_option( ldap.OPT_X_TLS_DEMAND, True )
+        l.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        #Bind to the server
         l.protocol_version = ldap.VERSION3
         l.simple_bind_s(LDAP_BIND_DN, LDAP_PASSWORD)
-    except ldap.LDAPError, e:
-        if type(e.message) == dict and e.message.has_key('desc'):
-            print e.message['desc']
-        else: 
-            print e
-            sys.exit(1)
-    try:
-        ldap_result_id = l.search(LDAP_USERS_BASE_DN, searchScope, searchFilter, None)
-        result_set = []
-        while 1:
-            result_type, result_data = l.result(ldap_result_id, 0)
-            if (result_data == []):
-                break
-            else:
-                if result_type == ldap.RES_SEARCH_ENTRY:
-                    result_set.append(result_data)
-    except ldap.LDAPError, e:
-        print e
-        sys.exit(1)
-    l.unbind_s()
-    return result_set[0][0]
+        return l, False
 
+    def _finish(self, replica, l):
+        if l is not None:
+            with self.lock:
+                replica.idle.append(l)
 
+    def _unbind(self, l):
+        try:
+            l.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _choose(self, exclude, healthy_only = False):
+        now = time.time()
+        with self.lock:
+            candidates = [replica for replica in self.replicas if replica not in exclude]
+            healthy = [replica for replica in candidates if replica.down_until <= now]
+            # When every replica is marked down, still give the remaining ones a try
+            if healthy or healthy_only:
+                candidates = healthy
+            if not candidates:
+                return None
+            pair = random.sample(candidates, min(2, len(candidates)))
+            return min(pair, key=lambda replica: (replica.latency or 0.0) * (replica.in_flight + 1))
+
+    def _hedge_after(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < 20:
+            return min(self.hedge_delay, self.timeout)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100.0))]
+
+    def _observe(self, replica, latency):
+        with self.lock:
+            replica.searches += 1
+            replica.latency = latency if replica.latency is None else 0.8 * replica.latency + 0.2 * latency
+            self.latencies.append(latency)
+
+    def _mark_down(self, replica, e):
+        with self.lock:
+            replica.failures += 1
+            replica.down_until = time.time() + self.cooldown
+            idle, replica.idle = replica.idle, []
+        for l in idle:
+            self._unbind(l)
+        LOG.warning("LDAP replica %s failed (%s), leaving it out for %ds", replica.url, e, self.cooldown)
+
+LDAP_POOL = None
 
 
-def getAllLDAPUsers():
+## LDAP routines
 
-    l = ldap.initialize(LDAP_HOST)
-    l.set_option(ldap.OPT_X_TLS,ldap.OPT_X_TLS_DEMAND)
-    l.set_option( ldap.OPT_X_TLS_DEMAND, True )
-    searchFilter = "(&(cn=*)(objectClass={0}))".format(USER_OBJECT_CLASS)
-    #this will scope the entire subtree under UserUnits
-    searchScope = ldap.SCOPE_SUBTREE
-    #Bind to the server
+## compact views of LDAP entries; searches only request the attributes these carry
+LDAPUserRecord = collections.namedtuple('LDAPUserRecord', ['dn', 'username', 'password_expiration'])
+LDAPGroupRecord = collections.namedtuple('LDAPGroupRecord', ['dn', 'groupname', 'members'])
+
+## requested for searches that only need the DNs of the matching entries (RFC 4511 "no attributes")
+LDAP_NO_ATTRIBUTES = ['1.1']
+
+
+def _user_attributes():
+    """
+    Returns the user attributes the current config reads: uid, plus
+    krbPasswordExpiration when password expiry is checked.
+    """
+    if CHECK_PASSWORD_EXPIRY:
+        return ['uid', 'krbPasswordExpiration']
+    return ['uid']
+
+
+def _decode_user(entry):
+    """
+    Converts a (dn, attributes) search result into an LDAPUserRecord.
+    """
+    user_dn, user_attrs = entry
+    uid = user_attrs.get('uid')
+    expiration = user_attrs.get('krbPasswordExpiration')
+    return LDAPUserRecord(user_dn, uid[0] if uid else _rdn_value(user_dn), expiration[0] if expiration else None)
+
+
+def _decode_group(entry):
+    """
+    Converts a (dn, attributes) search result into an LDAPGroupRecord.
+    """
+    group_dn, group_attrs = entry
+    cn = group_attrs.get('cn')
+    return LDAPGroupRecord(group_dn, cn[0] if cn else _rdn_value(group_dn), group_attrs.get('member') or [])
+
+
+def getLDAPUser(username):
+    searchFilter = "(&(uid={0})(objectClass={1}))".format(ldap.filter.escape_filter_chars(username), USER_OBJECT_CLASS)
     try:
-        l.protocol_version = ldap.VERSION3
-        l.simple_bind_s(LDAP_BIND_DN, LDAP_PASSWORD)
+        result_set = LDAP_POOL.search(LDAP_USERS_BASE_DN, searchFilter, _user_attributes())
     except ldap.LDAPError, e:
-        if type(e.message) == dict and e.message.has_key('desc'):
-            print e.message['desc']
-        else: 
-            print e
-            sys.exit(1)
+        LOG.error("%s", e)
+        sys.exit(1)
+    return _decode_user(result_set[0])
+
+
+def getAllLDAPUsers():
+    searchFilter = "(&(cn=*)(objectClass={0}))".format(USER_OBJECT_CLASS)
     try:
-        ldap_result_id = l.search(LDAP_USERS_BASE_DN, searchScope, searchFilter, None)
-        result_set = []
-        while 1:
-            result_type, result_data = l.result(ldap_result_id, 0)
-            if (result_data == []):
-                break
-            else:
-                if result_type == ldap.RES_SEARCH_ENTRY:
-                    result_set.append(result_data)
+        result_set = LDAP_POOL.search(LDAP_USERS_BASE_DN, searchFilter, _user_attributes())
     except ldap.LDAPError, e:
-        print e
+        LOG.error("%s", e)
         sys.exit(1)
-    l.unbind_s()
-    return result_set
+    return [_decode_user(entry) for entry in result_set]
 
 def getAllLDAPGroups():
-    l = ldap.initialize(LDAP_HOST)
-    l.set_option(ldap.OPT_X_TLS,ldap.OPT_X_TLS_DEMAND)
-    l.set_option( ldap.OPT_X_TLS_DEMAND, True )
     searchFilter = "(&(cn=*)(objectClass=posixGroup))"
-    #this will scope the entire subtree under UserUnits
-    searchScope = ldap.SCOPE_SUBTREE
-    #Bind to the server
     try:
-        l.protocol_version = ldap.VERSION3
-        l.simple_bind_s(LDAP_BIND_DN, LDAP_PASSWORD)
-    except ldap.INVALID_CREDENTIALS:
-        print 'Your LDAP username or password is incorrect'
-        sys.exit(1)
+        result_set = LDAP_POOL.search(LDAP_GROUPS_BASE_DN, searchFilter, ['cn', 'member'])
     except ldap.LDAPError, e:
-        if type(e.message) == dict and e.message.has_key('desc'):
-            print e.message['desc']
-        else: 
-            print e
-            sys.exit(1)
-    try:
-        ldap_result_id = l.search(LDAP_GROUPS_BASE_DN, searchScope, searchFilter, None)
-        result_set = []
-        while 1:
-            result_type, result_data = l.result(ldap_result_id, 0)
-            if (result_data == []):
-                break
-            else:
-                if result_type == ldap.RES_SEARCH_ENTRY:
-                    result_set.append(result_data)
-    except ldap.LDAPError, e:
-        print e
+        LOG.error("%s", e)
         sys.exit(1)
-    l.unbind_s()
-    return result_set
+    return [_decode_group(entry) for entry in result_set]
 
 def getLDAPGroup(group_name):
-    l = ldap.initialize(LDAP_HOST)
-    l.set_option(ldap.OPT_X_TLS,ldap.OPT_X_TLS_DEMAND)
-    l.set_option( ldap.OPT_X_TLS_DEMAND, True )
-    searchFilter = "(cn={0})".format(group_name)
-    #this will scope the entire subtree under UserUnits
-    searchScope = ldap.SCOPE_SUBTREE
-    #Bind to the server
-    try:
-        l.protocol_version = ldap.VERSION3
-        l.simple_bind_s(LDAP_BIND_DN, LDAP_PASSWORD)
-    except ldap.INVALID_CREDENTIALS:
-        print 'Your LDAP username or password is incorrect'
-        sys.exit(1)
-    except ldap.LDAPError, e:
-        if type(e.message) == dict and e.message.has_key('desc'):
-            print e.message['desc']
-        else: 
-            print e
-            sys.exit(1)
+    searchFilter = "(cn={0})".format(ldap.filter.escape_filter_chars(group_name))
     try:
-        ldap_result_id = l.search(LDAP_GROUPS_BASE_DN, searchScope, searchFilter, None)
-        result_set = []
-        while 1:
-            result_type, result_data = l.result(ldap_result_id, 0)
-            if (result_data == []):
-                break
-            else:
-                if result_type == ldap.RES_SEARCH_ENTRY:
-                    result_set.append(result_data)
+        result_set = LDAP_POOL.search(LDAP_GROUPS_BASE_DN, searchFilter, ['cn', 'member'])
     except ldap.LDAPError, e:
-        print e
+        LOG.error("%s", e)
         sys.exit(1)
-    l.unbind_s()
     try:
-        return result_set[0]
+        return _decode_group(result_set[0])
     except IndexError:
-        traceback.print_exc(file=sys.stdout)
-        print("Unexpected Error: {0} Could not find Group matching search criterea (check groupgroup name).".format(sys.exc_info()[0]))
+        LOG.error("Unexpected Error: %s Could not find Group matching search criterea (check groupgroup name).", sys.exc_info()[0], exc_info=True)
         sys.exit(1)
     return None
 
-#recursive algorithm for building up users in subclasses of a group, could be rewritten to use LDAP SUBTREE search calls
+def _ldap_search(base_dn, searchFilter, attrlist = None, searchScope = ldap.SCOPE_SUBTREE):
+    """
+    Runs a single search on the LDAP replicas.
+
+    Search errors are raised as ldap.LDAPError so callers can fall back.
+
+    Returns a list of (dn, attributes) tuples.
+    """
+    return LDAP_POOL.search(base_dn, searchFilter, attrlist, searchScope)
+
+
+def getGroupGroupMembers():
+    """
+    Returns the DNs of the groups in the groupgroup.
+    """
+    tableaugroupsgroup = getLDAPGroup(LDAP_GROUP_GROUP)
+    tableaugroupsgroupmembers = tableaugroupsgroup.members
+    if not tableaugroupsgroupmembers:
+        LOG.error("Unexpected Error: Group %s has no members. Check LDAP groupsBaseDN or login user DN", LDAP_GROUP_GROUP)
+        sys.exit(1)
+    return tableaugroupsgroupmembers
+
+def getLDAPGroupsContaining(dn):
+    """
+    Returns the lowercased DNs of all groups that contain 'dn', directly or
+    through nested groups. With the in-chain resolver the directory answers
+    in one search; otherwise the groups are walked upwards one level per search.
+    """
+    if _membership_resolver() == "inchain":
+        searchFilter = "(member:" + LDAP_MATCHING_RULE_IN_CHAIN + ":={0})".format(ldap.filter.escape_filter_chars(dn))
+        try:
+            return set(group_dn.lower() for group_dn, attrs in _ldap_search(LDAP_GROUPS_BASE_DN, searchFilter, LDAP_NO_ATTRIBUTES))
+        except ldap.LDAPError, e:
+            LOG.warning("In-chain group search failed for %s: %s, walking the groups instead", dn, e)
+    containing = set()
+    level = [dn]
+    while level:
+        searchFilter = "(|" + "".join("(member={0})".format(ldap.filter.escape_filter_chars(member_dn)) for member_dn in level) + ")"
+        try:
+            parents = [group_dn for group_dn, attrs in _ldap_search(LDAP_GROUPS_BASE_DN, searchFilter, LDAP_NO_ATTRIBUTES)]
+        except ldap.LDAPError, e:
+            LOG.error("%s", e)
+            sys.exit(1)
+        level = [group_dn for group_dn in parents if group_dn.lower() not in containing]
+        containing.update(group_dn.lower() for group_dn in level)
+    return containing
+
+def _rdn_attr(dn):
+    """
+    Returns the attribute type of the first RDN of 'dn' ("cn" for "cn=analysts,dc=example,dc=com").
+    """
+    return ldap.dn.str2dn(dn)[0][0][0]
+
+
+def _rdn_value(dn):
+    """
+    Returns the unescaped value of the first RDN of 'dn' ("Smith, John" for "cn=Smith\\, John,dc=example,dc=com").
+    """
+    return ldap.dn.str2dn(dn)[0][0][1]
+
+
+def _membership_resolver():
+    """
+    Returns the configured membership resolver. "auto" picks the in-chain
+    matching rule when the root DSE advertises Active Directory and the
+    client-side walk otherwise; the choice is made once per run.
+    """
+    global MEMBERSHIP_RESOLVER
+    if MEMBERSHIP_RESOLVER == "auto":
+        try:
+            root_dse = _ldap_search("", "(objectClass=*)", ['supportedCapabilities'], ldap.SCOPE_BASE)
+        except ldap.LDAPError, e:
+            LOG.warning("Could not read the LDAP root DSE (%s), using the client-side group walk", e)
+            root_dse = []
+        capabilities = root_dse[0][1].get('supportedCapabilities', []) if root_dse else []
+        MEMBERSHIP_RESOLVER = "inchain" if LDAP_CAP_ACTIVE_DIRECTORY in capabilities else "walk"
+        LOG.info("Using membership resolver: %s", MEMBERSHIP_RESOLVER)
+    return MEMBERSHIP_RESOLVER
+
+
+def _add_ldap_user_to_group(parent_group, ldap_user, group_name, users):
+    """
+    Adds an LDAPUserRecord to 'parent_group' and to 'users' (an LDAPUserList)
+    unless password expiry is checked and its password has expired.
+    """
+    current_username = ldap_user.username
+    if not CHECK_PASSWORD_EXPIRY:
+        users.add_to_group(current_username, parent_group)
+    elif ldap_user.password_expiration is not None:
+        passwordExpiration = dateutil.parser.parse(ldap_user.password_expiration)
+        timed = CURRENT_DATE_TIME - passwordExpiration
+        if timed.days > PASSWORD_EXPIRATION_LIMIT:
+            LOG.info("Discovered expired (%s days) LDAP user: %s in group: %s for parent group %s, %s days", PASSWORD_EXPIRATION_LIMIT, current_username, group_name, parent_group.groupname, timed.days)
+        else:
+            users.add_to_group(current_username, parent_group)
+    else:
+        LOG.warning("Found none type in krbPasswordExpiration for LDAP user %s in group %s for parent group %s", current_username, group_name, parent_group.groupname)
+
+
+#recursive algorithm for building up users in subclasses of a group. This is the fallback for
+#directories that cannot resolve transitive membership server-side (see getTransitiveUsersInGroup)
 # add users from "group_name" group to the "parent_group" while adding all users to the "users" list
 def getUsersInGroup(parent_group, group_name, users):
     user_objects_in_group = []
     temp_ldap_group = getLDAPGroup(group_name)
-    users_in_group = temp_ldap_group[0][1].get('member')
+    users_in_group = temp_ldap_group.members
     for groupuser in range(len(users_in_group)):
-        if (users_in_group[groupuser][0:2] == "cn"):
-            getUsersInGroup(parent_group, re.search("=(.*?),", users_in_group[groupuser]).group(1), users)
+        if (_rdn_attr(users_in_group[groupuser]).lower() == "cn"):
+            getUsersInGroup(parent_group, _rdn_value(users_in_group[groupuser]), users)
         else:
-            current_username = re.search("=(.*?),", users_in_group[groupuser]).group(1)
-            current_user_info = getLDAPUser(current_username)
-            if current_user_info[1].get('krbPasswordExpiration') is not None:
-                passwordExpiration = dateutil.parser.parse(current_user_info[1].get('krbPasswordExpiration')[0])
-                timed = CURRENT_DATE_TIME - passwordExpiration
-                if CHECK_PASSWORD_EXPIRY and timed.days > PASSWORD_EXPIRATION_LIMIT:
-                    print("Discovered expired ({0} days) LDAP user: {1} in group: {2} for parent group {3}, {4} days".format(PASSWORD_EXPIRATION_LIMIT, current_username, group_name, parent_group.groupname, timed.days))
-                else:
-                    user_found_in_users = False
-                    for alluse in range(len(users)):
-                        if current_username == users[alluse].username:
-                            users[alluse].memberOf.append(parent_group)
-                            parent_group.members.append(users[alluse])
-                            user_found_in_users = True
-                            break
-                    if not user_found_in_users:
-                        temp_user = User(current_username)
-                        temp_user.memberOf.append(parent_group)
-                        parent_group.members.append(temp_user)
-                        users.append(temp_user)
-            else:
-                print("Found none type in krbPasswordExpiration for LDAP user {0} in group {1} for parent group {2}".format(current_username, group_name, parent_group.groupname))
+            current_user_info = getLDAPUser(_rdn_value(users_in_group[groupuser]))
+            _add_ldap_user_to_group(parent_group, current_user_info, group_name, users)
     return user_objects_in_group
 
-## Calls recursive algorithm to build a group from groupname    
+# resolves all users nested anywhere below "ldap_group" (an LDAPGroupRecord) with one search, using the
+# in-chain matching rule (AD) or the memberOf/isMemberOf reverse attributes (389-DS).
+# Returns False if the directory rejected the search, or returned no users for a group that has members
+# (the attribute is not maintained), so the caller can fall back to getUsersInGroup
+def getTransitiveUsersInGroup(parent_group, ldap_group, resolver, users):
+    searchFilter = TRANSITIVE_MEMBER_FILTERS[resolver].format(USER_OBJECT_CLASS, ldap.filter.escape_filter_chars(ldap_group.dn))
+    try:
+        result_set = _ldap_search(LDAP_USERS_BASE_DN, searchFilter, _user_attributes())
+    except ldap.LDAPError, e:
+        LOG.warning("Transitive membership search (%s) failed for group %s: %s, falling back to the client-side walk", resolver, parent_group.groupname, e)
+        return False
+    if not result_set and ldap_group.members:
+        LOG.warning("Transitive membership search (%s) found no users in non-empty group %s, falling back to the client-side walk", resolver, parent_group.groupname)
+        return False
+    for entry in result_set:
+        _add_ldap_user_to_group(parent_group, _decode_user(entry), parent_group.groupname, users)
+    return True
+
+## Builds a group from groupname, server-side when the directory supports it, otherwise
+## with the recursive algorithm
 def buildGroup(group_name, users):
     temp_group = Group(group_name)
     temp_ldap_group = getLDAPGroup(group_name)
-    getUsersInGroup(temp_group, temp_group.groupname, users)
+    resolver = _membership_resolver()
+    if resolver == "walk" or not getTransitiveUsersInGroup(temp_group, temp_ldap_group, resolver, users):
+        getUsersInGroup(temp_group, temp_group.groupname, users)
     #check for duplicate users in list
-    i = 0
-    while i < len(temp_group.members):
-        j = i
-        while j < len(temp_group.members):
-            if ((temp_group.members[i].username == temp_group.members[j].username) and (i != j)):
-                temp_group.members.pop(j)
-            else:
-                j += 1
-        i += 1
+    unique_members = []
+    seen_usernames = set()
+    for member in temp_group.members:
+        if member.username not in seen_usernames:
+            seen_usernames.add(member.username)
+            unique_members.append(member)
+    temp_group.members = unique_members
 
     return temp_group
 
 
+## Plan and journal routines
+
+class Journal:
+    """
+    Write-ahead journal of the computed plan and of every completed operation.
+
+    The journal is a JSON-lines file. The first record holds the plan, every
+    following record marks one operation (by its position in the plan) as done.
+    Completion records are fsynced in batches of 'fsync_batch'; the journal is
+    also synced when it is closed, including when a run exits early.
+    """
+    def __init__(self, path, fsync_batch = None):
+        self.path = path
+        # read at construction time so the configured batch size applies
+        self.fsync_batch = fsync_batch if fsync_batch is not None else JOURNAL_FSYNC_BATCH
+        self.pending = 0
+        self.journal_file = None
+        self.lock = threading.RLock()
+
+    def begin(self, plan):
+        self.journal_file = open(self.path, 'w')
+        self._write({'type': 'plan', 'plan': plan})
+        self.sync()
+
+    def reopen(self, valid_length):
+        # Drops a partially written trailing record left behind by a crash
+        self.journal_file = open(self.path, 'r+')
+        self.journal_file.truncate(valid_length)
+        self.journal_file.seek(valid_length)
+
+    def record_done(self, seq, result = None):
+        with self.lock:
+            self._write({'type': 'done', 'seq': seq, 'result': result})
+            self.pending += 1
+            if self.pending >= self.fsync_batch:
+                self.sync()
+
+    def complete(self):
+        self._write({'type': 'complete'})
+        self.sync()
+
+    def sync(self):
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if self.journal_file is not None:
+                self.sync()
+                self.journal_file.close()
+                self.journal_file = None
+
+    def _write(self, record):
+        self.journal_file.write(json.dumps(record) + "\n")
+
+
+def load_journal(path):
+    """
+    Reads a journal written by a previous run.
+
+    Returns the plan (with IDs assigned during the previous run filled in), the
+    set of completed operation numbers, whether the run finished, and the length
+    of the journal up to the last complete record.
+    """
+    try:
+        journal_file = open(path, 'r')
+    except IOError:
+        LOG.error("Unexpected Error: Could not open journal %s, nothing to resume.", path)
+        sys.exit(1)
+    plan = None
+    completed = set()
+    finished = False
+    valid_length = 0
+    with journal_file:
+        for line in journal_file:
+            if not line.endswith("\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            valid_length += len(line)
+            if record['type'] == 'plan':
+                plan = record['plan']
+            elif record['type'] == 'done':
+                completed.add(record['seq'])
+                _apply_result(plan['operations'][record['seq']], record.get('result'), plan['user_ids'], plan['group_ids'])
+            elif record['type'] == 'complete':
+                finished = True
+    if plan is None:
+        LOG.error("Unexpected Error: Journal %s does not contain a plan, nothing to resume.", path)
+        sys.exit(1)
+    return plan, completed, finished, valid_length
+
+
+def build_plan(users_to_be_added, users_to_be_deleted, groups_to_be_added, groups_to_be_deleted, users_add_to_groups, users_del_from_groups):
+    """
+    Flattens the computed task lists into an ordered list of operations.
+
+    Operations refer to users and groups by name. IDs are kept in separate
+    name->ID maps so IDs assigned while executing (new users and groups) can
+    be recorded in the journal and restored on resume.
+
+    Returns a dictionary with 'operations', 'user_ids' and 'group_ids'.
+    """
+    operations = []
+    user_ids = {}
+    group_ids = {}
+    for user in users_to_be_added:
+        operations.append({'op': 'add_user', 'user': user.username})
+    for user in users_to_be_deleted:
+        operations.append({'op': 'remove_user', 'user': user.username})
+        user_ids[user.username] = user.user_id
+    for group in groups_to_be_added:
+        operations.append({'op': 'add_group', 'group': group.groupname})
+    for group in groups_to_be_deleted:
+        operations.append({'op': 'remove_group', 'group': group.groupname})
+        group_ids[group.groupname] = group.group_id
+    for membership in users_add_to_groups:
+        operations.append({'op': 'add_member', 'user': membership.get('user').username, 'group': membership.get('group').groupname})
+    for membership in users_del_from_groups:
+        operations.append({'op': 'remove_member', 'user': membership.get('user').username, 'group': membership.get('group').groupname})
+    for membership in users_add_to_groups + users_del_from_groups:
+        user = membership.get('user')
+        group = membership.get('group')
+        if user.user_id is not None:
+            user_ids[user.username] = user.user_id
+        if group.group_id is not None:
+            group_ids[group.groupname] = group.group_id
+    return {'operations': operations, 'user_ids': user_ids, 'group_ids': group_ids}
+
+
+# Order of operation kinds in an optimized plan. Only adding memberships depends on
+# other operations (the IDs of new users and groups), so everything else runs in the first round.
+OPERATION_ROUNDS = {'remove_group': 0, 'remove_user': 0, 'remove_member': 0, 'add_group': 0, 'add_user': 0, 'add_member': 1}
+OPERATION_ORDER = ['remove_group', 'remove_user', 'remove_member', 'add_group', 'add_user', 'add_member']
+
+
+def optimize_plan(plan):
+    """
+    Drops operations that other operations in the plan make unnecessary and
+    orders the rest into as few dependent rounds as possible.
+
+    - duplicate operations are merged into one
+    - removing a member from a group is dropped when the user or the group is
+      deleted in the same run, as the server removes the membership with it
+    - operations are sorted by OPERATION_ORDER, which puts everything that does
+      not depend on another operation into the first round of execute_plan
+
+    Returns the optimized plan.
+    """
+    operations = plan['operations']
+    removed_users = set(operation['user'] for operation in operations if operation['op'] == 'remove_user')
+    removed_groups = set(operation['group'] for operation in operations if operation['op'] == 'remove_group')
+    seen = set()
+    optimized = []
+    for operation in operations:
+        key = tuple(sorted(operation.items()))
+        if key in seen:
+            continue
+        seen.add(key)
+        if operation['op'] == 'remove_member' and (operation['user'] in removed_users or operation['group'] in removed_groups):
+            continue
+        optimized.append(operation)
+    optimized.sort(key=lambda operation: OPERATION_ORDER.index(operation['op']))
+    LOG.info("Plan optimizer: %d operations before, %d after, in %d rounds", len(operations), len(optimized),
+             len(set(OPERATION_ROUNDS[operation['op']] for operation in optimized)),
+             extra={'fields': {'operations_before': len(operations), 'operations_after': len(optimized)}})
+    return {'operations': optimized, 'user_ids': plan['user_ids'], 'group_ids': plan['group_ids']}
+
+
+def execute_plan(plan, journal, completed = None):
+    """
+    Executes the operations of a plan, recording each completed operation in
+    the journal. Operations in 'completed' are skipped.
+
+    Consecutive operations of the same round (see OPERATION_ROUNDS) are
+    independent of each other and run concurrently through the request
+    controller; each round finishes before the next one starts, so users and
+    groups exist before memberships are added.
+    """
+    if completed is None:
+        completed = set()
+    executed = {}
+    executed_lock = threading.Lock()
+
+    def run(seq):
+        operation = plan['operations'][seq]
+        result = _execute_operation(operation, plan['user_ids'], plan['group_ids'])
+        _apply_result(operation, result, plan['user_ids'], plan['group_ids'])
+        journal.record_done(seq, result)
+        with executed_lock:
+            executed[operation['op']] = executed.get(operation['op'], 0) + 1
+
+    try:
+        phase = []
+        for seq, operation in enumerate(plan['operations']):
+            if phase and OPERATION_ROUNDS[operation['op']] != OPERATION_ROUNDS[plan['operations'][phase[-1]]['op']]:
+                _parallel_map(run, phase)
+                phase = []
+            if seq not in completed:
+                phase.append(seq)
+        _parallel_map(run, phase)
+        journal.complete()
+    finally:
+        journal.close()
+        LOG.info("Executed %d operations (%s)", sum(executed.values()),
+                 ", ".join("{0}: {1}".format(op, count) for op, count in sorted(executed.items())),
+                 extra={'fields': {'executed': executed}})
+
+
+def _execute_operation(operation, user_ids, group_ids):
+    """
+    Executes a single plan operation against Tableau Server.
+
+    Returns the result to be journaled: {'id': ...} for created users and
+    groups, otherwise None.
+    """
+    op = operation['op']
+    username = operation.get('user')
+    groupname = operation.get('group')
+    debug = LOG.isEnabledFor(logging.DEBUG)
+    if op == 'add_user':
+        user_return = create_user(username)
+        if debug:
+            LOG.debug("Added user %s with ID: %s", username, user_return.get('id'),
+                      extra={'fields': {'op': op, 'user': username, 'user_id': user_return.get('id')}})
+        return {'id': user_return.get('id')}
+    elif op == 'remove_user':
+        remove_user(user_ids.get(username))
+        if debug:
+            LOG.debug("Removed user %s with ID: %s", username, user_ids.get(username),
+                      extra={'fields': {'op': op, 'user': username, 'user_id': user_ids.get(username)}})
+    elif op == 'add_group':
+        group_return = create_group(groupname)
+        if debug:
+            LOG.debug("Added group %s with ID: %s", groupname, group_return.get('id'),
+                      extra={'fields': {'op': op, 'group': groupname, 'group_id': group_return.get('id')}})
+        return {'id': group_return.get('id')}
+    elif op == 'remove_group':
+        remove_group(group_ids.get(groupname))
+        if debug:
+            LOG.debug("Removed group %s with ID: %s", groupname, group_ids.get(groupname),
+                      extra={'fields': {'op': op, 'group': groupname, 'group_id': group_ids.get(groupname)}})
+    elif op == 'add_member':
+        user_return = add_user_to_group(user_ids.get(username), group_ids.get(groupname))
+        if debug and user_return is not False:
+            LOG.debug("Added user %s to group %s%s", username, groupname, " (already a member)" if user_return is None else "",
+                      extra={'fields': {'op': op, 'user': username, 'group': groupname}})
+    elif op == 'remove_member':
+        remove_user_from_group(user_ids.get(username), group_ids.get(groupname))
+        if debug:
+            LOG.debug("Removed user %s from group %s", username, groupname,
+                      extra={'fields': {'op': op, 'user': username, 'group': groupname}})
+    return None
+
+
+def _apply_result(operation, result, user_ids, group_ids):
+    """
+    Stores the ID assigned by a create operation in the plan's ID maps.
+    """
+    if result is None:
+        return
+    if operation['op'] == 'add_user':
+        user_ids[operation['user']] = result.get('id')
+    elif operation['op'] == 'add_group':
+        group_ids[operation['group']] = result.get('id')
+
+
+## Group fingerprint routines
+
+def fingerprint(usernames):
+    """
+    Returns a content hash of a set of usernames, independent of their order.
+    """
+    names = set(name.decode('utf-8') if isinstance(name, bytes) else name for name in usernames if name is not None)
+    return hashlib.sha1(u"\n".join(sorted(names)).encode('utf-8')).hexdigest()
+
+
+class FingerprintStore:
+    """
+    Fingerprints of every group's resolved LDAP member set and of its Tableau
+    member set after the last completed run, kept in a JSON file.
+
+    A group whose LDAP fingerprint is unchanged, whose last sync converged and
+    whose Tableau members were verified within 'verify_hours' does not need its
+    Tableau membership fetched or diffed. Verification times are per group, so
+    full checks are spread over runs and still catch out-of-band edits.
+    """
+    def __init__(self, path, verify_hours = FINGERPRINT_VERIFY_HOURS):
+        self.path = path
+        self.verify_hours = verify_hours
+        self.groups = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fingerprint_file:
+                self.groups = json.load(fingerprint_file).get('groups', {})
+        except (IOError, ValueError):
+            self.groups = {}
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as fingerprint_file:
+            json.dump({'groups': self.groups}, fingerprint_file)
+            fingerprint_file.flush()
+            os.fsync(fingerprint_file.fileno())
+        os.rename(temp_path, self.path)
+
+    def is_unchanged(self, groupname, group_id, ldap_fingerprint, now):
+        entry = self.groups.get(groupname)
+        return (entry is not None and entry.get('group_id') == group_id
+                and entry.get('ldap') == ldap_fingerprint
+                and entry.get('tableau') == ldap_fingerprint
+                and now - entry.get('verified', 0) < self.verify_hours * 3600)
+
+    def verify(self, groupname, tableau_fingerprint):
+        """
+        Returns False if the fetched Tableau members differ from the ones
+        recorded after the last completed run.
+        """
+        entry = self.groups.get(groupname)
+        return entry is None or entry.get('tableau') == tableau_fingerprint
+
+    def record(self, groupname, group_id, ldap_fingerprint, tableau_fingerprint, verified):
+        self.groups[groupname] = {'group_id': group_id, 'ldap': ldap_fingerprint,
+                                  'tableau': tableau_fingerprint, 'verified': verified}
+
+    def forget(self, groupnames):
+        """
+        Drops the entries of 'groupnames'. Returns True if any entry was dropped.
+        """
+        return len([groupname for groupname in groupnames if self.groups.pop(groupname, None) is not None]) > 0
+
+
+def forget_planned_fingerprints(plan):
+    """
+    Drops the fingerprints of every group the plan changes and saves the file
+    before the plan is executed, so a run that is interrupted (and resumed)
+    never leaves a changed group recorded as converged.
+    """
+    groupnames = set(operation['group'] for operation in plan['operations'] if 'group' in operation)
+    if not groupnames:
+        return
+    fingerprints = FingerprintStore(FINGERPRINT_PATH, FINGERPRINT_VERIFY_HOURS)
+    fingerprints.load()
+    if fingerprints.forget(groupnames):
+        fingerprints.save()
 
 
-    
 def main():
     global SITE_ID
     global MY_USER_ID
     global TOKEN
 
-    users = []
+    if RESUME:
+        resume()
+        return
+    if TARGET_USERS or TARGET_GROUPS:
+        targeted_sync(TARGET_USERS, TARGET_GROUPS)
+        return
+
+    users = LDAPUserList()
     groups = []
 
     if MODE == "groupgroup":
         ##pull groups from LDAP and populate group ob0jects
-        tableaugroupsgroup = getLDAPGroup(LDAP_GROUP_GROUP)
-        tableaugroupsgroupmembers = tableaugroupsgroup[0][1].get('member')
-    
-        try:
-            ldaptableaugroups = []
-            for member in tableaugroupsgroupmembers:
-                ldaptableaugroups.append(re.search("=(.*?),", member).group(1))
-            print("Groups:")
+        ldaptableaugroups = [_rdn_value(member) for member in getGroupGroupMembers()]
+        LOG.info("Found %d groups in %s", len(ldaptableaugroups), LDAP_GROUP_GROUP)
+        if LOG.isEnabledFor(logging.DEBUG):
             for mem in ldaptableaugroups:
-                print("    Member: {0}".format(mem))
-        except TypeError:
-            traceback.print_exc(file=sys.stdout)
-            print("Unexpected Error: {0} Check LDAP groupsBaseDN or login user DN".format(sys.exc_info()[0]))
-            sys.exit(1)
-        
-        #loop through all of the groups that were in the tableaugroups group
-        for i in range(len(ldaptableaugroups)):
-            temp_group = buildGroup(ldaptableaugroups[i], users)
-            groups.append(temp_group)
+                LOG.debug("    Member: %s", mem)
+
+        #expand all of the groups that were in the tableaugroups group concurrently
+        _membership_resolver()
+        groups = _parallel_map(lambda group_name: buildGroup(group_name, users), ldaptableaugroups, LDAP_WORKERS)
     elif MODE == "all":
         #TODO: create all routine
         pass
+    LDAP_POOL.log_metrics()
+    LDAP_POOL.close()
     #sign into Tableau Server REST API
-    print("Signing in")
+    LOG.info("Signing in")
     TOKEN, SITE_ID, MY_USER_ID = sign_in(USER, PASSWORD)
-    print("Successfully logged in...\n")
+    LOG.info("Successfully logged in")
 
     #retrieve list of Tableau users
     tab_users = query_users()
@@ -632,16 +1603,40 @@ def main():
     #retreieve list of Tableau groups
     tab_groups = query_groups()
 
+    INDEX.load_users(tab_users)
+    INDEX.load_groups(tab_groups)
+
+    ## skip groups whose LDAP members and Tableau members have not changed since the last run
+    now = time.time()
+    fingerprints = FingerprintStore(FINGERPRINT_PATH, FINGERPRINT_VERIFY_HOURS)
+    if not FULL_VERIFY:
+        fingerprints.load()
+    ldap_fingerprints = dict((g.groupname, fingerprint(m.username for m in g.members)) for g in groups)
+    #groups with members that are missing on Tableau Server are always checked, their memberships need to be added
+    groups_with_new_users = set(g.groupname for g in groups for m in g.members if m.username not in INDEX.user_ids)
+    unchanged_groups = set()
+    for tab_group in tab_groups:
+        groupname = tab_group.get('name')
+        if groupname in ldap_fingerprints and groupname not in groups_with_new_users and \
+                fingerprints.is_unchanged(groupname, tab_group.get('id'), ldap_fingerprints[groupname], now):
+            unchanged_groups.add(groupname)
+    LOG.info("Skipping %d of %d groups with unchanged membership fingerprints", len(unchanged_groups), len(groups),
+             extra={'fields': {'unchanged_groups': len(unchanged_groups)}})
 
     ## create group objects for Tabserv groups
     tab_group_objects = []
-    for i in range(len(tab_groups)):
-        if tab_groups[i].get('name') != "All Users": #don't process all users. those tasks can be accomplished by doing a query on all Tableau Users
-            temp_group = Group(tab_groups[i].get('name'), tab_groups[i].get('id'))
-            temp_users_in_group = get_users_in_group(temp_group.group_id)
-            for j in range(len(temp_users_in_group)):
-                temp_group.members.append(User(temp_users_in_group[j].get('name'), temp_users_in_group[j].get('id')))
-            tab_group_objects.append(temp_group)
+    #don't process all users. those tasks can be accomplished by doing a query on all Tableau Users
+    tab_groups_to_fetch = [tab_group for tab_group in tab_groups if tab_group.get('name') != "All Users" and tab_group.get('name') not in unchanged_groups]
+    tab_groups_members = _parallel_map(lambda tab_group: get_users_in_group(tab_group.get('id')), tab_groups_to_fetch)
+    for i in range(len(tab_groups_to_fetch)):
+        temp_group = Group(tab_groups_to_fetch[i].get('name'), tab_groups_to_fetch[i].get('id'))
+        temp_users_in_group = tab_groups_members[i]
+        for j in range(len(temp_users_in_group)):
+            temp_group.members.append(User(temp_users_in_group[j].get('name'), temp_users_in_group[j].get('id')))
+            INDEX.add_member(temp_group.group_id, temp_users_in_group[j].get('id'))
+        if not fingerprints.verify(temp_group.groupname, fingerprint(m.username for m in temp_group.members)):
+            LOG.info("Group %s was changed on Tableau Server since the last run", temp_group.groupname)
+        tab_group_objects.append(temp_group)
     ## create User objects for Tabserv users
     tab_user_objects = []
     for i in range(len(tab_users)):
@@ -649,31 +1644,19 @@ def main():
         tab_user_objects.append(temp_user)
 
 
-    for j in range(len(users)):
-        if users[j].username == "nohlson":
-            users[j].user_id = "hey"
-
-    #debug purposes only:
-    #####for debug purposes only#####
-    print("\n")
-    print("LDAP Users (Total: "+ str(len(users)) + "):")
-    for u in users:
-        print("Username: {0}, id: {1}".format(u.username, u.user_id))
-    print("\n")
-
-    print("LDAP Groups (Total: "+ str(len(groups)) + "):")
-    for g in groups:
-        print("Groupname: {0}, (Total: {1}):".format(g.groupname, len(g.members)))
-        for m in g.members:
-            print("    Username: {0}, id: {1}".format(m.username, m.user_id))
-    print("Tableau Users (Total: "+ str(len(tab_user_objects)) + "):")
-    for tu in tab_user_objects:
-        print("Username: {0}, id:{1}".format(tu.username, tu.user_id))
-    print("Tableau Groups (Total: "+str(len(tab_group_objects)) + "):")
-    for tg in tab_group_objects:
-        print("Groupname: {0} {1} (Total: {2}):".format(tg.groupname, tg.group_id, len(tg.members)))
-        for tgm in tg.members:
-            print("    Username: {0}, id: {1}".format(tgm.username, tgm.user_id))
+    LOG.info("LDAP users: %d, LDAP groups: %d, Tableau users: %d, Tableau groups: %d",
+             len(users), len(groups), len(tab_user_objects), len(tab_group_objects) + len(unchanged_groups),
+             extra={'fields': {'ldap_users': len(users), 'ldap_groups': len(groups),
+                               'tableau_users': len(tab_user_objects), 'tableau_groups': len(tab_group_objects) + len(unchanged_groups)}})
+    if LOG.isEnabledFor(logging.DEBUG):
+        for u in users:
+            LOG.debug("LDAP user: %s, id: %s", u.username, u.user_id)
+        for g in groups:
+            LOG.debug("LDAP group: %s (Total: %d): %s", g.groupname, len(g.members), ", ".join(m.username for m in g.members))
+        for tu in tab_user_objects:
+            LOG.debug("Tableau user: %s, id: %s", tu.username, tu.user_id)
+        for tg in tab_group_objects:
+            LOG.debug("Tableau group: %s %s (Total: %d): %s", tg.groupname, tg.group_id, len(tg.members), ", ".join(m.username for m in tg.members))
 
 
 
@@ -712,21 +1695,11 @@ def main():
     users_to_be_added = []
     groups_to_be_added = []
     for i in range(len(users)):
-        user_in_both = False
-        for j in range(len(tab_users)):
-            if (users[i].username == tab_users[j].get('name')):
-                user_in_both = True
-                break
-        if not user_in_both:
+        if users[i].username not in INDEX.user_ids:
             users_to_be_added.append(users[i])
 
     for i in range(len(groups)):
-        group_in_both = False
-        for j in range(len(tab_groups)):
-            if (groups[i].groupname == tab_groups[j].get('name')):
-                group_in_both = True
-                break
-        if not group_in_both:
+        if groups[i].groupname not in INDEX.group_ids:
             groups_to_be_added.append(groups[i])
     ##########################################################################
 
@@ -765,105 +1738,257 @@ def main():
                         if (tab_group_objects[i].members[k].username == groups[j].members[m].username):
                             found_in_both_groups = True
                             break
+                    #memberships of users that are deleted in this run are dropped by optimize_plan
                     if not found_in_both_groups:
-                        found_in_delete_list = False
-                        for n in range(len(user_objects_to_be_deleted)):
-                            if (user_objects_to_be_deleted[n] == tab_group_objects[i].members[k].user_id):
-                                found_in_delete_list = True
-                                break
-                        if not found_in_delete_list:
-                            users_del_from_groups.append({'user':tab_group_objects[i].members[k], 'group':tab_group_objects[i]})
+                        users_del_from_groups.append({'user':tab_group_objects[i].members[k], 'group':tab_group_objects[i]})
     
 
-    print("\nTABSYNC Tasks:\n")
-
-    print("Users to be deleted from Tableau Server:")
-    for delus in user_objects_to_be_deleted:
-        print("    {0}, {1}".format(delus.username, delus.user_id))
-    print("Groups to be deleted from Tableau Server:")
-    for delgro in group_objects_to_be_deleted:
-        print("    {0}, {1}".format(delgro.groupname, delgro.group_id))
-    print("Users to be added to Tableau Server:")
-    for adus in users_to_be_added:
-        print("    {0}".format(adus.username))
-    print("Groups to be added to Tableau Server:")
-    for adgr in groups_to_be_added:
-        print("    {0}".format(adgr.groupname))
-    print("Users to be added to groups:")
-    for uadd in users_add_to_groups:
-        print("    {0} with ID {1} will be added to group {2} with ID {3}".format(uadd.get('user').username, uadd.get('user').user_id, uadd.get('group').groupname, uadd.get('group').group_id))
-
-    print("Users to be deleted from groups:")
-    for udel in users_del_from_groups:
-        print("    {0} with ID {1} will be deleted from group {2} with ID {3}".format(udel.get('user').username, udel.get('user').user_id, udel.get('group').groupname, udel.get('group').group_id))
-
-
-    print("Execute tasks:\n")
-
-
-    ###EXECUTE TASKS######
-    ##Add Users
-    print("Add Users:")
-    for i in range(len(users_to_be_added)):
-        print("    Adding user: {0}".format(users_to_be_added[i].username))
-        user_return = create_user(users_to_be_added[i].username)
-        user_return_id = user_return.get('id')
-        users_to_be_added[i].user_id = user_return_id
-        print("    Success! User {0} was added with ID: {1}".format(user_return.get('name'), user_return_id))
-
-    ##Del Users
-    print("Remove Users:")
-    for i in range(len(user_objects_to_be_deleted)):
-        print("    Removing user: {0} with ID: {1}".format(user_objects_to_be_deleted[i].username, user_objects_to_be_deleted[i].user_id))
-        remove_user(user_objects_to_be_deleted[i].user_id)
-        print("    User deleted.")
-
-
-    ##Add Groups
-    print("Add Groups:")
-    for i in range(len(groups_to_be_added)):
-        print("    Adding group: {0}".format(groups_to_be_added[i].groupname))
-        group_return = create_group(groups_to_be_added[i].groupname)
-        group_return_id = group_return.get('id')
-        groups_to_be_added[i].group_id = group_return_id
-        print("    Success! Group {0} was added with ID: {1}".format(group_return.get('name'), group_return_id))
-
-
-    ##Del Groups
-    print("Remove Groups:")
-    for i in range(len(group_objects_to_be_deleted)):
-        print("    Removing group: {0} with ID: {1}".format(group_objects_to_be_deleted[i].groupname, group_objects_to_be_deleted[i].group_id))
-        remove_group(group_objects_to_be_deleted[i].group_id)
-        print("    Group deleted.")
-
-
-    ##Add users to Groups
-    print("Add users to groups:")
-    for i in range(len(users_add_to_groups)):
-        t_username = users_add_to_groups[i].get('user').username
-        t_user_id = users_add_to_groups[i].get('user').user_id
-        t_groupname = users_add_to_groups[i].get('group').groupname
-        t_group_id = users_add_to_groups[i].get('group').group_id
-        print("    Adding user {0} with ID: {1} to group {2} with ID {3}".format(t_username, t_user_id, t_groupname, t_group_id))
-        user_return = add_user_to_group(t_user_id, t_group_id)
-        user_return_id = user_return.get('id')
-        print("    Success! User {0} was added to {1}".format(user_return.get('name'), t_groupname))
-
-    ##Del users from Groups
-    print("Remove Users from Groups:")
-    for i in range(len(users_del_from_groups)):
-        t_username = users_del_from_groups[i].get('user').username
-        t_user_id = users_del_from_groups[i].get('user').user_id
-        t_groupname = users_del_from_groups[i].get('group').groupname
-        t_group_id = users_del_from_groups[i].get('group').group_id
-        print("    Deleting user {0} with ID: {1} from group {2} with ID {3}".format(t_username, t_user_id, t_groupname, t_group_id))
-        remove_user_from_group(t_user_id, t_group_id)
-        print("    Deleted user from group.")
+    LOG.info("TABSYNC Tasks: %d users to delete, %d groups to delete, %d users to add, %d groups to add, %d memberships to add, %d memberships to delete",
+             len(user_objects_to_be_deleted), len(group_objects_to_be_deleted), len(users_to_be_added), len(groups_to_be_added),
+             len(users_add_to_groups), len(users_del_from_groups),
+             extra={'fields': {'users_to_delete': len(user_objects_to_be_deleted), 'groups_to_delete': len(group_objects_to_be_deleted),
+                               'users_to_add': len(users_to_be_added), 'groups_to_add': len(groups_to_be_added),
+                               'memberships_to_add': len(users_add_to_groups), 'memberships_to_delete': len(users_del_from_groups)}})
+    if LOG.isEnabledFor(logging.DEBUG):
+        for delus in user_objects_to_be_deleted:
+            LOG.debug("User to be deleted from Tableau Server: %s, %s", delus.username, delus.user_id)
+        for delgro in group_objects_to_be_deleted:
+            LOG.debug("Group to be deleted from Tableau Server: %s, %s", delgro.groupname, delgro.group_id)
+        for adus in users_to_be_added:
+            LOG.debug("User to be added to Tableau Server: %s", adus.username)
+        for adgr in groups_to_be_added:
+            LOG.debug("Group to be added to Tableau Server: %s", adgr.groupname)
+        for uadd in users_add_to_groups:
+            LOG.debug("%s with ID %s will be added to group %s with ID %s", uadd.get('user').username, uadd.get('user').user_id, uadd.get('group').groupname, uadd.get('group').group_id)
+        for udel in users_del_from_groups:
+            LOG.debug("%s with ID %s will be deleted from group %s with ID %s", udel.get('user').username, udel.get('user').user_id, udel.get('group').groupname, udel.get('group').group_id)
+
+    plan = optimize_plan(build_plan(users_to_be_added, user_objects_to_be_deleted, groups_to_be_added, group_objects_to_be_deleted, users_add_to_groups, users_del_from_groups))
+    journal = Journal(JOURNAL_PATH)
+    journal.begin(plan)
+    forget_planned_fingerprints(plan)
+
+    LOG.info("Execute tasks")
+    try:
+        execute_plan(plan, journal)
+    finally:
+        log_request_metrics()
+
+    ## record the fingerprints of every group that was synced in this run
+    synced_groups = {}
+    for group in groups:
+        group_id = INDEX.group_ids.get(group.groupname)
+        if group_id is None:
+            continue
+        if group.groupname in unchanged_groups:
+            synced_groups[group.groupname] = fingerprints.groups[group.groupname]
+        else:
+            tableau_members = [INDEX.user_names.get(user_id) for user_id in INDEX.members.get(group_id, ())]
+            fingerprints.record(group.groupname, group_id, ldap_fingerprints[group.groupname], fingerprint(tableau_members), now)
+            synced_groups[group.groupname] = fingerprints.groups[group.groupname]
+    fingerprints.groups = synced_groups
+    fingerprints.save()
+
+
+def journal_unfinished(path):
+    """
+    Returns True if the journal at 'path' holds a plan whose run has not completed.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+    plan, completed, finished, valid_length = load_journal(path)
+    return not finished
+
+
+def targeted_sync(usernames, groupnames):
+    """
+    Synchronizes only the named users and groups.
+
+    For a user, LDAP is asked which groupgroup members contain the user and
+    Tableau Server for the user and the groups it is in; the user is created,
+    added to or removed from groups, or deleted when it is in no group. For a
+    group, only that group is expanded in LDAP and its members are looked up
+    one by one on Tableau Server. Users that a targeted group sync leaves in
+    no group are deleted by the next full run.
+
+    A targeted run shares the journal of full runs, so it refuses to start
+    while the journal records an unfinished run.
+    """
+    global SITE_ID
+    global MY_USER_ID
+    global TOKEN
+
+    if journal_unfinished(JOURNAL_PATH):
+        LOG.error("Unexpected Error: Journal %s records an unfinished run. Complete it with --resume before a targeted sync.", JOURNAL_PATH)
+        sys.exit(1)
+
+    groupgroup_dns = getGroupGroupMembers()
+    groupgroup_names = dict((member_dn.lower(), _rdn_value(member_dn)) for member_dn in groupgroup_dns)
+
+    ## resolve the targets in LDAP
+    ldap_users = LDAPUserList()
+    user_groups = {}
+    for username in usernames:
+        try:
+            user_entries = _ldap_search(LDAP_USERS_BASE_DN, "(&(uid={0})(objectClass={1}))".format(ldap.filter.escape_filter_chars(username), USER_OBJECT_CLASS), _user_attributes())
+        except ldap.LDAPError, e:
+            LOG.error("%s", e)
+            sys.exit(1)
+        user_groups[username] = []
+        if not user_entries:
+            LOG.info("User %s was not found in LDAP", username)
+            continue
+        ldap_user = _decode_user(user_entries[0])
+        for group_dn in getLDAPGroupsContaining(ldap_user.dn):
+            if group_dn in groupgroup_names:
+                temp_group = Group(groupgroup_names[group_dn])
+                _add_ldap_user_to_group(temp_group, ldap_user, temp_group.groupname, ldap_users)
+                if temp_group.members:
+                    user_groups[username].append(temp_group)
+    ldap_groups = {}
+    _membership_resolver()
+    for groupname in groupnames:
+        ldap_groups[groupname] = buildGroup(groupname, ldap_users) if groupname in groupgroup_names.values() else None
+    LDAP_POOL.log_metrics()
+    LDAP_POOL.close()
+
+    LOG.info("Signing in")
+    TOKEN, SITE_ID, MY_USER_ID = sign_in(USER, PASSWORD)
+    LOG.info("Successfully logged in")
+
+    ## look up only the affected users and groups on Tableau Server
+    affected_groupnames = set(groupnames)
+    for groups_of_user in user_groups.values():
+        affected_groupnames.update(group.groupname for group in groups_of_user)
+    affected_groupnames = sorted(affected_groupnames)
+    tab_groups = dict((name, group) for name, group in zip(affected_groupnames, _parallel_map(query_group_by_name, affected_groupnames)) if group is not None)
+    for tab_group in tab_groups.values():
+        INDEX.add_group(tab_group.get('name'), tab_group.get('id'))
+
+    tab_group_members = {}
+    targeted_tab_groups = [tab_groups[name] for name in groupnames if name in tab_groups]
+    for tab_group, members in zip(targeted_tab_groups, _parallel_map(lambda tab_group: get_users_in_group(tab_group.get('id')), targeted_tab_groups)):
+        tab_group_members[tab_group.get('name')] = members
+        for member in members:
+            INDEX.add_user(member.get('name'), member.get('id'))
+            INDEX.add_member(tab_group.get('id'), member.get('id'))
+
+    lookup_usernames = set(usernames)
+    for ldap_group in ldap_groups.values():
+        if ldap_group is not None:
+            lookup_usernames.update(member.username for member in ldap_group.members)
+    lookup_usernames = sorted(username for username in lookup_usernames if username not in INDEX.user_ids)
+    for tab_user in _parallel_map(query_user_by_name, lookup_usernames):
+        if tab_user is not None:
+            INDEX.add_user(tab_user.get('name'), tab_user.get('id'))
+
+    ## compute the delta
+    users_to_be_added = []
+    users_to_be_deleted = []
+    groups_to_be_added = []
+    groups_to_be_deleted = []
+    users_add_to_groups = []
+    users_del_from_groups = []
+
+    def tab_group_object(name):
+        if name not in tab_groups:
+            temp_group = Group(name)
+            groups_to_be_added.append(temp_group)
+            tab_groups[name] = temp_group
+            return temp_group
+        if isinstance(tab_groups[name], Group):
+            return tab_groups[name]
+        return Group(name, tab_groups[name].get('id'))
+
+    def ldap_user_object(name):
+        user = User(name, INDEX.user_ids.get(name))
+        if user.user_id is None and name not in [added.username for added in users_to_be_added]:
+            users_to_be_added.append(user)
+        return user
+
+    for username in usernames:
+        desired = set(group.groupname for group in user_groups[username])
+        user_id = INDEX.user_ids.get(username)
+        current = {}
+        if user_id is not None:
+            for tab_group in get_groups_for_user(user_id):
+                if tab_group.get('name') != "All Users":
+                    current[tab_group.get('name')] = tab_group
+        if not desired:
+            if user_id is not None and username != "admin":
+                users_to_be_deleted.append(User(username, user_id))
+            continue
+        user = ldap_user_object(username)
+        for groupname in sorted(desired):
+            if groupname not in current:
+                users_add_to_groups.append({'user': user, 'group': tab_group_object(groupname)})
+        for groupname in sorted(current):
+            if groupname not in desired:
+                users_del_from_groups.append({'user': user, 'group': Group(groupname, current[groupname].get('id'))})
+
+    for groupname in groupnames:
+        ldap_group = ldap_groups[groupname]
+        if ldap_group is None:
+            if groupname in tab_groups and groupname != "All Users":
+                groups_to_be_deleted.append(Group(groupname, tab_groups[groupname].get('id')))
+            continue
+        group = tab_group_object(groupname)
+        tab_members = set(member.get('name') for member in tab_group_members.get(groupname, []))
+        ldap_members = set(member.username for member in ldap_group.members)
+        for username in sorted(ldap_members - tab_members):
+            users_add_to_groups.append({'user': ldap_user_object(username), 'group': group})
+        for member in tab_group_members.get(groupname, []):
+            if member.get('name') not in ldap_members:
+                users_del_from_groups.append({'user': User(member.get('name'), member.get('id')), 'group': group})
+
+    LOG.info("TABSYNC targeted tasks: %d users to delete, %d groups to delete, %d users to add, %d groups to add, %d memberships to add, %d memberships to delete",
+             len(users_to_be_deleted), len(groups_to_be_deleted), len(users_to_be_added), len(groups_to_be_added),
+             len(users_add_to_groups), len(users_del_from_groups))
+
+    plan = optimize_plan(build_plan(users_to_be_added, users_to_be_deleted, groups_to_be_added, groups_to_be_deleted, users_add_to_groups, users_del_from_groups))
+    journal = Journal(JOURNAL_PATH)
+    journal.begin(plan)
+    # the next full run re-checks and re-records the groups this run changes
+    forget_planned_fingerprints(plan)
+
+    LOG.info("Execute tasks")
+    try:
+        execute_plan(plan, journal)
+    finally:
+        log_request_metrics()
 
 
+def resume():
+    """
+    Continues an interrupted run from the journal without querying LDAP or
+    Tableau Server again. Operations already recorded as completed are skipped.
+    """
+    global SITE_ID
+    global MY_USER_ID
+    global TOKEN
+
+    plan, completed, finished, valid_length = load_journal(JOURNAL_PATH)
+    if finished:
+        LOG.info("Journal %s records a completed run, nothing to resume.", JOURNAL_PATH)
+        return
+
+    LOG.info("Signing in")
+    TOKEN, SITE_ID, MY_USER_ID = sign_in(USER, PASSWORD)
+    LOG.info("Successfully logged in")
+
+    LOG.info("Resuming from journal %s: %d of %d operations already completed.", JOURNAL_PATH, len(completed), len(plan['operations']))
+    journal = Journal(JOURNAL_PATH)
+    journal.reopen(valid_length)
+    forget_planned_fingerprints(plan)
+    LOG.info("Execute tasks")
+    try:
+        execute_plan(plan, journal, completed)
+    finally:
+        log_request_metrics()
+
 
 def printUsage():
-    print("Tabsync usage:\n    python tabsync.py\nModes:\n    -g:    group group MODE(default)\n    -a:    all mode\n\nSee README for more information")
+    print("Tabsync usage:\n    python tabsync.py [-c config] [-g | -a] [-v] [--json-log] [--full] [--resume] [--user name]... [--group name]...\nModes:\n    -g:    group group MODE(default)\n    -a:    all mode\nOptions:\n    -c:          path to config file (default config/config.yml)\n    -v:          log per-entity and per-task detail (debug level)\n    --json-log:  write the log as JSON lines\n    --full:      fetch and diff the Tableau membership of every group, ignoring fingerprints\n    --resume:    continue an interrupted run from the journal\n    --user:      only synchronize this user (repeatable)\n    --group:     only synchronize this group (repeatable)\n\nSee README for more information")
 
 
 
@@ -875,23 +2000,61 @@ if __name__ == '__main__':
     configfile = "config/config.yml"
     MODE = "groupgroup"
     try:
-        opts, args = getopt.getopt(sys.argv, "hd:c:")
+        opts, args = getopt.getopt(sys.argv[1:], "hgavc:", ["resume", "json-log", "full", "user=", "group="])
         for opt, arg in opts:
-            if opt == '-c':
+            if opt == '-h':
+                printUsage()
+                sys.exit(0)
+            elif opt == '-c':
                 configfile = arg
             elif opt == '-g':
                 MODE = 'groupgroup'
             elif opt == '-a':
                 MODE = 'all'
+            elif opt == '--resume':
+                RESUME = True
+            elif opt == '-v':
+                LOG_LEVEL = "debug"
+            elif opt == '--json-log':
+                LOG_JSON = True
+            elif opt == '--full':
+                FULL_VERIFY = True
+            elif opt == '--user':
+                TARGET_USERS.append(arg)
+            elif opt == '--group':
+                TARGET_GROUPS.append(arg)
+        if RESUME and (TARGET_USERS or TARGET_GROUPS):
+            raise getopt.GetoptError("--resume cannot be combined with --user or --group")
         
         with open(configfile, 'r') as ymlfile:
             config = yaml.load(ymlfile)
     
+        tabsync_config = config.get('tabsync') or {}
+        JOURNAL_PATH = tabsync_config.get('journal', JOURNAL_PATH)
+        JOURNAL_FSYNC_BATCH = int(tabsync_config.get('journalfsyncbatch', JOURNAL_FSYNC_BATCH))
+        FINGERPRINT_PATH = tabsync_config.get('fingerprints', FINGERPRINT_PATH)
+        FINGERPRINT_VERIFY_HOURS = float(tabsync_config.get('fingerprintverifyhours', FINGERPRINT_VERIFY_HOURS))
+        if LOG_LEVEL != "debug":
+            LOG_LEVEL = str(tabsync_config.get('loglevel', LOG_LEVEL)).lower()
+        if LOG_LEVEL not in LOG_LEVELS:
+            raise KeyError('loglevel')
+        LOG_JSON = LOG_JSON or bool(tabsync_config.get('jsonlog', False))
+        MEMBERSHIP_RESOLVER = config['ldap'].get('membershipresolver', MEMBERSHIP_RESOLVER)
+        LDAP_WORKERS = int(config['ldap'].get('workers', LDAP_WORKERS))
+        LDAP_HOSTS = config['ldap'].get('hosts') or [config['ldap']['host']]
+        LDAP_POOL = LDAPReplicaPool(LDAP_HOSTS, float(config['ldap'].get('timeout', LDAP_TIMEOUT)),
+                                    float(config['ldap'].get('hedgepercentile', LDAP_HEDGE_PERCENTILE)),
+                                    float(config['ldap'].get('replicacooldown', LDAP_REPLICA_COOLDOWN)))
+        FILTER_API_VERSION = str(config['tableau'].get('filterapiversion', FILTER_API_VERSION))
+        CONTROLLER = RequestController(int(config['tableau'].get('maxconcurrency', REST_MAX_CONCURRENCY)),
+                                       float(config['tableau'].get('timeout', REST_TIMEOUT)),
+                                       int(config['tableau'].get('maxretries', REST_MAX_RETRIES)))
+        if MEMBERSHIP_RESOLVER not in ("walk", "auto") and MEMBERSHIP_RESOLVER not in TRANSITIVE_MEMBER_FILTERS:
+            raise KeyError('membershipresolver')
         SERVER = config['tableau']['server'] # Set to the server URL without a trailing slash (/).
         USER = config['tableau']['user']
         PASSWORD = config['tableau']['password']
         CERT_PATH = config['tableau']['certpath']
-        LDAP_HOST = config['ldap']['host']
         LDAP_BIND_DN = config['ldap']['bindDN']
         LDAP_PASSWORD = config['ldap']['password']
         LDAP_GROUPS_BASE_DN = config['ldap']['groupsbaseDN']
@@ -905,10 +2068,11 @@ if __name__ == '__main__':
         traceback.print_exc(file=sys.stdout)
         print("Unexpected Error: {0} Incorrect or incomplete config file.".format(sys.exc_info()[0]))
         sys.exit(1)
-    except getopt.GetoptError:
-        print("Unexpected Error: {0} Incorrect arguments")
+    except getopt.GetoptError, e:
+        print("Unexpected Error: {0} Incorrect arguments".format(e))
         printUsage()
         sys.exit(1)
+    configure_logging(LOG_LEVEL, LOG_JSON)
     main()
 
 